@@ -1,23 +1,19 @@
-#!/usr/bin/env python3.6
+#!/usr/bin/env python3
 
 import signal
 import sys
 import argparse
 import datetime
-from dateutil import parser
-from astral.geocoder import lookup, database
-from astral.sun import sun
+import time
 import csv
-import pytz
+from zoneinfo import ZoneInfo
 import os
 import os.path
-import requests
+import shutil
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import json
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import numpy as np
 
 
 #################### TEST MODE KNOB #####################
@@ -32,6 +28,9 @@ FORCEDAY = False                          # force daytime behaviour
 FORCEEOD = False                          # force EOD behaviour
 #FORCEEOD = True
 
+DAEMONMODE = False                        # stay resident, run every minute
+#DAEMONMODE = True
+
 #########################################################
 
 
@@ -44,7 +43,7 @@ ENDOFDAY = False
 HELPNOTES = """This tool captures data from Fronius inverters.
 
 It is designed to be run every minute via a cron job with output to a
-web server.
+web server, or left running with --daemon.
 
 Most important variables are configurable near the top of the source. Dig deeper if
 you want to customise more.
@@ -107,15 +106,22 @@ def parse_cmdline():
     parser.add_argument("-d", action='store_true', default=False, help="force daytime")
     parser.add_argument("-e", action='store_true', default=False, help="force end of day")
     parser.add_argument("-t", action='store_true', default=False, help="enable test mode")
+    parser.add_argument("--daemon", action='store_true', default=False, \
+                        help="stay resident and capture every minute")
 
     return parser.parse_args()
 
-#   Pull data from inverter
+#   Pull data from inverter. The session is made by run_capture on the first
+#   daytime run. The two API calls run at the same time so each needs its own
+#   connection, the session only saves reconnecting between daemon iterations
+
+SESSION = None
 
-def call_inverter(inverterUrl):
+def call_inverter(session, inverterUrl):
+    import requests
+    data = None
     try:
-        response = requests.get(url=inverterUrl)
-        data = json.loads(response.text)
+        data = session.get(url=inverterUrl, timeout=10).json()
         errorStatus = "OK"
     except requests.exceptions.ConnectionError as ex:
         errorStatus = "Cannot connect to inverter"
@@ -125,30 +131,49 @@ def call_inverter(inverterUrl):
 
 #   Plot the graph(s)
 
+_FIG_CACHE = {}
+
 def draw_graph(plotFnames, plotCfg, plotLabel, plotSysVal):
 
-    #   Read the data from the main and String CSV files
-
-    data = np.genfromtxt(plotFnames['dCsv'],
-                         unpack=True,
-                         names=['timestamp','watts','total'],
-                         dtype=None,
-                         delimiter = ',',
-                         converters={0: lambda x: parser.parse(x)})
-    xAgg = data['timestamp']
-    yAgg = data['watts']
-
-    maxPwr = max(yAgg)
-
-    data = np.genfromtxt(plotFnames['sCsv'],
-                         unpack=True,
-                         names=['timestamp','string1','string2'],
-                         dtype=None,
-                         delimiter = ',',
-                         converters={0: lambda x: parser.parse(x)})
-    xStr = data['timestamp']
-    yStr1 = data['string1']
-    yStr2 = data['string2']
+    #   matplotlib, numpy and pandas are slow to import and only needed when
+    #   drawing, so they are loaded here rather than on every run
+
+    import numpy as np
+    import pandas as pd
+    import matplotlib as mpl
+    mpl.use('Agg')
+    mpl.rcParams['timezone'] = TIMEZONE  #Tell matplotlib to use local TZ
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    from matplotlib.collections import PolyCollection
+
+    #   Read the data from the main and String CSV files. We write both
+    #   files ourselves so the timestamp formats are known up front
+
+    dfAgg = pd.read_csv(plotFnames['dCsv'],
+                        header=None,
+                        names=['timestamp','watts'],
+                        engine='c')
+    xAgg = pd.to_datetime(dfAgg['timestamp'], format='%Y-%m-%dT%H:%M:%S.%f%z', utc=True, \
+                          cache=True).dt.tz_convert(TIMEZONE).to_numpy()
+    yAgg = dfAgg['watts'].to_numpy()
+
+    dfStr = pd.read_csv(plotFnames['sCsv'],
+                        header=None,
+                        names=['timestamp','string1','string2'],
+                        engine='c')
+    xStr = pd.to_datetime(dfStr['timestamp'], format='%Y-%m-%dT%H:%M:%S%z', utc=True, \
+                          cache=True).dt.tz_convert(TIMEZONE).to_numpy()
+    yStr1 = dfStr['string1'].to_numpy()
+    yStr2 = dfStr['string2'].to_numpy()
+
+    #   Total and peak of the readings, from the running stats if they were
+    #   kept for the whole day, otherwise from the CSV
+
+    stats = read_daily_stats(plotFnames['dStats'])
+    if stats is None:
+        stats = yAgg.sum(), yAgg.max()
+    total, maxPwr = stats
 
     #   Calculate the total kWh generated.
     #   Sum the readings and divide by 60. (Because we read every minute &
@@ -156,42 +181,59 @@ def draw_graph(plotFnames, plotCfg, plotLabel, plotSysVal):
     #   Divide by 1,000 to get kWh
     #   Only need 2 decimal places of precision
 
-    kWh = round((sum(yAgg) / 60 / 1000), 2)
+    kWh = round((total / 60 / 1000), 2)
 
     money = plotLabel['cur'] + '{:.2f}'.format((round((kWh * plotLabel['kWval']), 2)))
 
-    #   Start the graph
+    #   Start the graph. The figure is kept between runs in daemon mode and
+    #   only cleared, saving rebuilding it every minute
 
-    fig, ax = plt.subplots(figsize=(16, 9))
+    if 'fig' in _FIG_CACHE:
+        fig, ax = _FIG_CACHE['fig'], _FIG_CACHE['ax']
+        ax.cla()
+    else:
+        fig, ax = plt.subplots(figsize=(16, 9))
+        _FIG_CACHE['fig'] = fig
+        _FIG_CACHE['ax'] = ax
 
     #   Plot string data overlay
 
     ax.plot(xStr, yStr1, 'm', label=plotLabel['str1'], linewidth=1)
     ax.plot(xStr, yStr2, 'b', label=plotLabel['str2'], linewidth=1)
 
-    #   Total power colour masks
-
-    mask0 = yAgg <   500
-    mask1 = yAgg >=  500
-    mask2 = yAgg >= 1000
-    mask3 = yAgg >= 1500
-    mask4 = yAgg >= 2000
-    mask5 = yAgg >= 2500
-    mask6 = yAgg >= 3000
-    mask7 = yAgg >= 3500
-    mask8 = yAgg >= 4000
-
-    #   Plot main power bars
-
-    plt.bar(xAgg[mask0], yAgg[mask0], width=.002, color = '#F0FF00')
-    plt.bar(xAgg[mask1], yAgg[mask1], width=.002, color = '#F1DF00')
-    plt.bar(xAgg[mask2], yAgg[mask2], width=.002, color = '#F3BF00')
-    plt.bar(xAgg[mask3], yAgg[mask3], width=.002, color = '#F59F00')
-    plt.bar(xAgg[mask4], yAgg[mask4], width=.002, color = '#F77F00')
-    plt.bar(xAgg[mask5], yAgg[mask5], width=.002, color = '#F95F00')
-    plt.bar(xAgg[mask6], yAgg[mask6], width=.002, color = '#FB3F00')
-    plt.bar(xAgg[mask7], yAgg[mask7], width=.002, color = '#FD1F00')
-    plt.bar(xAgg[mask8], yAgg[mask8], width=.002, color = '#ff0000')
+    #   Readings closer together than a pixel column of the 05:00 - 23:00 axis
+    #   can't be told apart, so keep only the peak reading in each column
+
+    xBar = mdates.date2num(xAgg)
+    yBar = yAgg
+    pxPerDay = ax.get_window_extent().width * 24 / 18
+    column = np.floor(xBar * pxPerDay).astype(np.int64)
+    starts = np.flatnonzero(np.diff(column, prepend=column[0] - 1))
+    if len(starts) < len(xBar):
+        xBar = xBar[starts]
+        yBar = np.maximum.reduceat(yBar, starts)
+
+    #   Total power colour per bar, one colour band every 500W
+
+    tier = np.digitize(yBar, [500, 1000, 1500, 2000, 2500, 3000, 3500, 4000])
+    palette = np.array(['#F0FF00', '#F1DF00', '#F3BF00', '#F59F00', '#F77F00', \
+                        '#F95F00', '#FB3F00', '#FD1F00', '#ff0000'])
+    colors = palette[tier]
+
+    #   Plot main power bars as a single collection of rectangles rather than
+    #   one artist per bar. Bars overlap so draw in tier order to keep the
+    #   higher bands on top
+
+    order = np.argsort(tier, kind='stable')
+    xBar = xBar[order]
+    yBar = yBar[order]
+    zero = np.zeros_like(xBar)
+    bars = np.stack([np.column_stack([xBar - .001, zero]),
+                     np.column_stack([xBar - .001, yBar]),
+                     np.column_stack([xBar + .001, yBar]),
+                     np.column_stack([xBar + .001, zero])], axis=1)
+    ax.add_collection(PolyCollection(bars, facecolors=colors[order], \
+                                     edgecolors='none', linewidths=0), autolim=False)
 
     #   Set legend
 
@@ -199,12 +241,15 @@ def draw_graph(plotFnames, plotCfg, plotLabel, plotSysVal):
 
     #   X axis
 
-    hours = mdates.HourLocator()
-    hoursFmt = mdates.DateFormatter('%H:%M')
-    ax.xaxis.set_major_locator(hours)
-    ax.xaxis.set_major_formatter(hoursFmt)
-
     day = xAgg[0]
+
+    #   Hourly ticks are fixed so set them directly rather than have a
+    #   locator work them out on every draw
+
+    hours = range(5, 24)
+    ax.set_xticks([day.replace(hour=h, minute=0, second=0, microsecond=0) for h in hours])
+    ax.set_xticklabels(['{:02d}:00'.format(h) for h in hours])
+
     xStart = day.replace(hour=5,  minute=0, second=0) # 0500
     xEnd   = day.replace(hour=23, minute=0, second=0) # 2300
 
@@ -230,20 +275,20 @@ def draw_graph(plotFnames, plotCfg, plotLabel, plotSysVal):
 
     #   Set the labels
 
-    plt.xlabel(today + "\nfroniator version: " + plotLabel['ver'] + "\nSunrise: " + \
+    plt.xlabel(plotLabel['today'] + "\nfroniator version: " + plotLabel['ver'] + "\nSunrise: " + \
                str(plotLabel['sunrise']) + " - Sunset: " + \
                str(plotLabel['sunset']))
 
     plt.ylabel("Generated Electricity (Watts)")
 
     graphTitle = plotLabel['loc'] + " PV at " + \
-                 now.strftime("%d/%m/%Y, %H:%M:%S") + "\nGenerated " + \
+                 plotLabel['now'].strftime("%d/%m/%Y, %H:%M:%S") + "\nGenerated " + \
                  str(kWh) + "kWh - " + plotLabel['expStr'] + ' ' + money
 
     if plotSysVal['eod']:
         graphTitle = graphTitle + " - Daily Summary"
     else:
-        graphTitle = graphTitle +  " - Current Output " + str(watts) + " W"
+        graphTitle = graphTitle +  " - Current Output " + str(plotSysVal['watts']) + " W"
 
     #   If testmode, mark up the graph to show this
 
@@ -264,9 +309,26 @@ def draw_graph(plotFnames, plotCfg, plotLabel, plotSysVal):
 
     return kWh, maxPwr
 
+#   Pull the string channels out as time ordered arrays of readings along
+#   with their seconds from midnight. All channels share the same timestamps
+#   so only the first is sorted, the rest are read back in that key order
+
+def string_channels(stringData, channels):
+    import numpy as np
+    data = stringData['Body']['Data']['inverter/1']['Data']
+    keys = list(data[channels[0]]['Values'])
+    secs = np.fromiter(map(int, keys), dtype=np.int64, count=len(keys))
+    order = np.argsort(secs)
+    keys = [keys[i] for i in order]
+    readings = [np.fromiter(map(float, map(data[channel]['Values'].__getitem__, keys)), \
+                            dtype=np.float64, count=len(keys)) for channel in channels]
+    return secs[order], readings
+
 #   Convert the raw inverter data to Watts and the string data to a consistent timestamp format
 
-def calculate_power(pwrData, stringData):
+def calculate_power(pwrData, stringData, today):
+    import numpy as np
+    import pandas as pd
 
     #   Calculate inverter total pwr output
 
@@ -274,55 +336,31 @@ def calculate_power(pwrData, stringData):
 
     #   Calculate per string power data
 
-    string1cur = stringData['Body']['Data']['inverter/1']['Data'] \
-                           ['Current_DC_String_1']['Values']
-    #   Keys to ints, Values to floats
-    string1cur = {int(k):float(v) for k,v in string1cur.items()}
-    string1cur = sorted(string1cur.items())
-
-    string2cur = stringData['Body']['Data']['inverter/1']['Data'] \
-                           ['Current_DC_String_2']['Values']
-    #   Keys to ints, Values to floats
-    string2cur = {int(k):float(v) for k,v in string2cur.items()}
-    string2cur = sorted(string2cur.items())
-
-    string1volt = stringData['Body']['Data']['inverter/1']['Data'] \
-                            ['Voltage_DC_String_1']['Values']
-    #   Keys to ints, Values to floats
-    string1volt = {int(k):float(v) for k,v in string1volt.items()}
-    string1volt = sorted(string1volt.items())
-
-    string2volt = stringData['Body']['Data']['inverter/1']['Data'] \
-                            ['Voltage_DC_String_2']['Values']
-    #   Keys to ints, Values to floats
-    string2volt = {int(k):float(v) for k,v in string2volt.items()}
-    string2volt = sorted(string2volt.items())
-
-    timestampList = []
-    str1watts  = []
-    str2watts  = []
-
-    #  Convert string timestamps into ISO timestamps and calculate P=IV
-
-    for current, voltage in zip(string1cur, string1volt):
-        timeFromMidnight = datetime.timedelta(seconds = current[0])
-        timestamp = datetime.datetime.strptime("{} {}".format(today, \
-                                              timeFromMidnight), "%Y-%m-%d %H:%M:%S")
-        timestamp = zone.localize(timestamp)
-        timestamp = timestamp.isoformat()
-        timestampList.append(str(timestamp))
-        str1watts.append(int(current[1] * voltage[1]))
-
-    for current, voltage in zip(string2cur, string2volt):
-        str2watts.append(int(current[1] * voltage[1]))
-
-    #       Remove the first 4:30 hours (54 * 5 minutes)
+    secs, (c1, v1, c2, v2) = string_channels(stringData, \
+                                             ['Current_DC_String_1', 'Voltage_DC_String_1', \
+                                              'Current_DC_String_2', 'Voltage_DC_String_2'])
+
+    #       Remove the first 4:30 hours (54 * 5 minutes) before doing any
+    #       work on them
     #       Earliest sunrise about 04:40
     #       Latest sunset about 2130
 
-    timestampList = timestampList[54:]
-    str1watts  = str1watts[54:]
-    str2watts  = str2watts[54:]
+    secs = secs[54:]
+    c1, v1 = c1[54:], v1[54:]
+    c2, v2 = c2[54:], v2[54:]
+
+    #   Calculate P=IV for each string
+
+    str1watts = (c1 * v1).astype(np.int32)
+    str2watts = (c2 * v2).astype(np.int32)
+
+    #   Convert string timestamps (seconds from midnight) into ISO timestamps.
+    #   strftime gives the offset as +HHMM, isoformat() style is +HH:MM
+
+    timestamps = (pd.Timestamp(today) + pd.to_timedelta(secs, unit='s')) \
+                 .tz_localize(zone, ambiguous=False, nonexistent='shift_forward')
+    timestampList = timestamps.strftime('%Y-%m-%dT%H:%M:%S%z')
+    timestampList = timestampList.str[:-2] + ':' + timestampList.str[-2:]
 
     return watts, timestampList, str1watts, str2watts
 
@@ -333,30 +371,116 @@ def write_history_html(isHistoryHtml, HISTORYHTML, histHtmlStr):
         with open(HISTORYHTML, 'a') as file:
             file.write(histHtmlStr + "\n")
     else:
-        with open(HISTORYHTML, 'r+') as file:
-            historyContent = file.read()
-            file.seek(0, 0)
-            file.write(histHtmlStr + "\n")
-            file.write(historyContent)
+
+        #   Stream the new line and then the old file into a temp file
+        #   alongside and swap it in, so the whole history is never in memory.
+        #   The temp file is removed if anything fails so it isn't left in
+        #   the web directory
+
+        with open(HISTORYHTML, 'rb') as oldFile, \
+             tempfile.NamedTemporaryFile(dir=os.path.dirname(HISTORYHTML), \
+                                         delete=False) as newFile:
+            try:
+                newFile.write((histHtmlStr + "\n").encode())
+                shutil.copyfileobj(oldFile, newFile)
+                newFile.close()
+                shutil.copymode(HISTORYHTML, newFile.name)
+                os.replace(newFile.name, HISTORYHTML)
+            except BaseException:
+                os.unlink(newFile.name)
+                raise
     return
 
 
-#   General purpose CSV writer
+#   General purpose CSV writer. In daemon mode the file is kept open between
+#   writes and flushed, only one file is held at a time and it is reopened
+#   if it is written to after another file or has been removed
+
+_CSV_HANDLES = {}
 
 def write_csv(filename, *args):
-    csvRow = []
-    for ar in args:
-        csvRow.append(ar)
-    with open(filename, 'a', newline='') as csv_file:
-        writer = csv.writer(csv_file)
-        writer = writer.writerow(csvRow)
+    if DAEMONMODE:
+        if filename not in _CSV_HANDLES or not os.path.isfile(filename):
+            for csv_file, _ in _CSV_HANDLES.values():
+                csv_file.close()
+            _CSV_HANDLES.clear()
+            csv_file = open(filename, 'a', newline='')
+            _CSV_HANDLES[filename] = (csv_file, csv.writer(csv_file))
+        csv_file, writer = _CSV_HANDLES[filename]
+        writer.writerow(args)
+        csv_file.flush()
+    else:
+        with open(filename, 'a', newline='') as csv_file:
+            csv.writer(csv_file).writerow(args)
+    return
+
+#   Running total and peak of the day's readings, kept next to the daily CSV
+#   so they don't have to be worked out from the whole CSV. They are started
+#   afresh on the first reading of the day, replacing any old file. If the
+#   file is missing part way through the day the CSV is used instead
+
+def read_daily_stats(statsFile):
+    try:
+        with open(statsFile) as file:
+            stats = json.load(file)
+        return stats['total'], stats['peak']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def update_daily_stats(statsFile, watts, firstRun):
+    if firstRun:
+        stats = 0, watts
+    else:
+        stats = read_daily_stats(statsFile)
+        if stats is None:
+            return
+    total, peak = stats
+    with open(statsFile, 'w') as file:
+        json.dump({'total' : total + watts, 'peak' : max(peak, watts)}, file)
     return
 
+#   Sunrise and sunset for the day. Looking up the city and working out the
+#   sun times only changes once a day, so the result is cached in the archive
+#   directory and reused by every other run that day
+
+def sun_times(today):
+    cacheFile = os.path.join(ARCHIVEPATH, '.sun.json')
+    try:
+        with open(cacheFile) as file:
+            cache = json.load(file)
+        if cache['date'] == today and cache['city'] == CITYNAME:
+            return datetime.datetime.fromisoformat(cache['sunrise']), \
+                   datetime.datetime.fromisoformat(cache['sunset'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    from astral.geocoder import lookup, database
+    from astral.sun import sun
+    city = lookup(CITYNAME, database())
+    sunInfo = sun(city.observer, tzinfo=city.timezone)  #Set TZ for sun up/down
+
+    #   Cache through a temp file so a reader never sees it half written.
+    #   The cache is only a shortcut, if it can't be written carry on without
+
+    tempName = None
+    try:
+        with tempfile.NamedTemporaryFile('w', dir=ARCHIVEPATH, \
+                                         delete=False) as file:
+            tempName = file.name
+            json.dump({'date' : today, 'city' : CITYNAME, \
+                       'sunrise' : sunInfo['sunrise'].isoformat(), \
+                       'sunset' : sunInfo['sunset'].isoformat()}, file)
+        os.replace(tempName, cacheFile)
+    except OSError:
+        if tempName is not None and os.path.exists(tempName):
+            os.unlink(tempName)
+    return sunInfo['sunrise'], sunInfo['sunset']
+
 #   Error logs to stdout to be captured during cron runs
 
 def log_errors(isDailyPng, isDailyCsv, isStringCsv, FIRSTRUN, ERRORSTATUS, timeIso):
     if isDailyPng and isDailyCsv and isStringCsv:
-        sys.exit(0)
+        return
     elif isDailyPng:
         print("\n" + timeIso + " Daily PNG already exists")
     elif not isDailyCsv and not FIRSTRUN:
@@ -371,36 +495,6 @@ def log_errors(isDailyPng, isDailyCsv, isStringCsv, FIRSTRUN, ERRORSTATUS, timeI
 
 ###############################################################################
 
-#   Sun information
-
-city = lookup(CITYNAME, database())
-sun = sun(city.observer, tzinfo=city.timezone)  #Set TZ for sun up/down
-tzInfo = (sun['sunrise']).tzinfo
-
-#   Time information
-
-mpl.rcParams['timezone'] = TIMEZONE  #Tell matplotlib to use local TZ
-now   = datetime.datetime.now()
-zone  = pytz.timezone(TIMEZONE)
-now   = zone.localize(now)           #Create 'now' with TZ offset info
-today = now.strftime("%Y-%m-%d")     #Date for filenames
-timeIso = now.isoformat()            #Time written to CSV
-
-timeNow = datetime.datetime.now(tzInfo)
-sunrise = sun['sunrise']
-sunset = sun['sunset']
-
-#   API URLs
-
-powerApiUrl = "http://" + INVERTERIP + \
-              "/solar_api/v1/GetInverterRealtimeData.cgi?Scope=System"
-
-stringApiUrl = "http://" + INVERTERIP + \
-               "/solar_api/v1/GetArchiveData.cgi?Scope=System&StartDate=" + \
-               today + "&EndDate=" + today + "&Channel=Voltage_DC_String_1" + \
-               "&Channel=Current_DC_String_1&Channel=Voltage_DC_String_2" + \
-               "&Channel=Current_DC_String_2"
-
 #   Check Test mode cmd line override
 
 args = parse_cmdline()
@@ -415,6 +509,16 @@ if args.e:
 if args.t:
     TESTMODE = True
 
+if args.daemon:
+    DAEMONMODE = True
+
+#   Forced day or EOD would repeat every minute in daemon mode, so they are
+#   only allowed for single runs
+
+if DAEMONMODE and (FORCEDAY or FORCEEOD):
+    print("\nForced daytime or EOD can't be used in daemon mode")
+    sys.exit(2)
+
 
 #   Set up paths for test mode
 
@@ -429,107 +533,181 @@ if FORCEEOD:
 if FORCEDAY:
     print("\nFORCED DAYTIME ON")
 
-#   Set the filenames to use timestamp and correct path
-
-tstampFilename =  os.path.join(ARCHIVEPATH, today)
-dailyCsv = tstampFilename + ".csv"
-dailyPng = tstampFilename + ".png"
-stringCsv = tstampFilename + "-string.csv"
-stringPng = tstampFilename + "-string.png"
-historyPngLoc = os.path.join(WEBPATH, today + ".png")
+if DAEMONMODE:
+    print("\nDAEMON MODE ON")
 
 SUMMARYCSV = os.path.join(ARCHIVEPATH, SUMMARYCSV)
 LIVEIMAGE = os.path.join(LIVEPATH, LIVEIMAGE)
 HISTORYHTML = os.path.join(LIVEPATH, HISTORYHTML)
 
+#   Time zone information
+
+zone  = ZoneInfo(TIMEZONE)
 
-#   Check which files exist
 
-isDailyCsv = os.path.isfile(dailyCsv)
-isDailyPng = os.path.isfile(dailyPng)
-isStringCsv = os.path.isfile(stringCsv)
-isHistoryHtml = os.path.isfile(HISTORYHTML)
+###############################################################################
 
-#   Set the HTML to write to the top of the history page source
+#   One capture iteration. Run once from cron, or once a minute in daemon mode
 
-histHtmlStr = '<p style="text-align:center;"><img src="' + \
-              historyPngLoc + '" alt="' + today + \
-              '"></p>'
+def run_capture():
 
-#   Setup dictionaries to pass to draw_graph()
+    global FIRSTRUN, ERRORSTATUS, SESSION
 
-plotFnames = { 'dCsv' : dailyCsv, 'sCsv' : stringCsv, 'dPng' : dailyPng, \
-               'lPng' : LIVEIMAGE }
-plotCfg = {'min' : PVMIN, 'max' : PVMAX, 'step' : PVSTEP}
-plotLabel = {'cur' : CURR, 'kWval' : KWHVALUE, 'str1' : PVSTRING1, \
-             'str2' : PVSTRING2, 'loc' : MYLOCATION, \
-             'expStr' : EXPORTSTRING, 'ver' : VERSION, 'sunrise' : sunrise,\
-             'sunset' : sunset}
-plotSysVal = {'test' : TESTMODE, 'err' : ERRORSTATUS, 'eod' : ENDOFDAY}
+    FIRSTRUN = True
+    ERRORSTATUS = "OK"
 
+    #   Time information
 
-###############################################################################
+    now   = datetime.datetime.now(zone)  #Create 'now' with TZ offset info
+    today = now.strftime("%Y-%m-%d")     #Date for filenames
+    timeIso = now.isoformat(timespec='microseconds') #Time written to CSV
+
+    #   Sun information
+
+    sunrise, sunset = sun_times(today)
+    tzInfo = sunrise.tzinfo
+
+    timeNow = datetime.datetime.now(tzInfo)
+
+    #   Before sunrise there is nothing to capture or draw
+
+    if timeNow < sunrise and not FORCEDAY and not FORCEEOD:
+        return
+
+    #   API URLs
 
-#   When FIRSTRUN is true (start of new day) we don't draw the graph until we
-#   have at least 2 entries in the CSV
+    powerApiUrl = "http://" + INVERTERIP + \
+                  "/solar_api/v1/GetInverterRealtimeData.cgi?Scope=System"
 
-if isDailyCsv:
-    FIRSTRUN = False
+    stringApiUrl = "http://" + INVERTERIP + \
+                   "/solar_api/v1/GetArchiveData.cgi?Scope=System&StartDate=" + \
+                   today + "&EndDate=" + today + "&Channel=Voltage_DC_String_1" + \
+                   "&Channel=Current_DC_String_1&Channel=Voltage_DC_String_2" + \
+                   "&Channel=Current_DC_String_2"
 
-#   During daylight try to connect to inverter
+    #   Set the filenames to use timestamp and correct path
 
-if (timeNow > sunrise and \
-        timeNow < sunset and not FORCEEOD) or FORCEDAY:
+    tstampFilename =  os.path.join(ARCHIVEPATH, today)
+    dailyCsv = tstampFilename + ".csv"
+    dailyPng = tstampFilename + ".png"
+    stringCsv = tstampFilename + "-string.csv"
+    dailyStats = tstampFilename + "-stats.json"
+    stringPng = tstampFilename + "-string.png"
+    historyPngLoc = os.path.join(WEBPATH, today + ".png")
 
-    #   Collect data from inverter API
+    #   Check which files exist
 
-    pwrData, ERRORSTATUS = call_inverter(powerApiUrl)
-    stringData, ERRORSTATUS = call_inverter(stringApiUrl)
+    isDailyCsv = os.path.isfile(dailyCsv)
+    isDailyPng = os.path.isfile(dailyPng)
+    isStringCsv = os.path.isfile(stringCsv)
+    isHistoryHtml = os.path.isfile(HISTORYHTML)
 
-    if ERRORSTATUS == "OK":
+    #   Set the HTML to write to the top of the history page source
 
-        watts, timestampList, str1watts, str2watts =  calculate_power(pwrData, \
-                                                      stringData)
+    histHtmlStr = '<p style="text-align:center;"><img src="' + \
+                  historyPngLoc + '" alt="' + today + \
+                  '"></p>'
 
-        #   Write out the aggregate and string CSVs
+    #   Setup dictionaries to pass to draw_graph()
 
-        write_csv(dailyCsv, timeIso, watts)
+    plotFnames = { 'dCsv' : dailyCsv, 'sCsv' : stringCsv, 'dPng' : dailyPng, \
+                   'lPng' : LIVEIMAGE, 'dStats' : dailyStats }
+    plotCfg = {'min' : PVMIN, 'max' : PVMAX, 'step' : PVSTEP}
+    plotLabel = {'cur' : CURR, 'kWval' : KWHVALUE, 'str1' : PVSTRING1, \
+                 'str2' : PVSTRING2, 'loc' : MYLOCATION, \
+                 'expStr' : EXPORTSTRING, 'ver' : VERSION, 'sunrise' : sunrise,\
+                 'sunset' : sunset, 'today' : today, 'now' : now}
+    plotSysVal = {'test' : TESTMODE, 'err' : ERRORSTATUS, 'eod' : ENDOFDAY, \
+                  'watts' : None}
 
-        #   Inverter returns the whole day of string data so this is an overwrite
+    ###########################################################################
 
-        with open(stringCsv, 'w', newline='') as csv_file:
-            writer = csv.writer(csv_file)
-            for a, b in zip(zip(timestampList, str1watts), str2watts):
-                t  = str(a[0])
-                w1 = str(a[1])
-                w2 = str(b)
-                writer.writerow([t,w1,w2])
+    #   When FIRSTRUN is true (start of new day) we don't draw the graph until we
+    #   have at least 2 entries in the CSV
 
-        #   Only draw the graph if the CSV file exists and its not the first
-        #   iteration of the day
+    if isDailyCsv:
+        FIRSTRUN = False
 
-        if isDailyCsv and not FIRSTRUN:
+    #   During daylight try to connect to inverter
 
-            draw_graph(plotFnames, plotCfg, plotLabel, plotSysVal)
+    if (timeNow > sunrise and \
+            timeNow < sunset and not FORCEEOD) or FORCEDAY:
 
-#   At the end of the day save an archive image and CSV of timestamp,
-#   kWh and peak output for the day. Overlay per string data.
+        #   Collect data from inverter API, both calls at the same time.
+        #   Report the first error if either fails
 
-if (timeNow > sunset and not isDailyPng and isDailyCsv and \
-    isStringCsv and not FORCEDAY) or FORCEEOD:
+        if SESSION is None:
+            import requests
+            SESSION = requests.Session()
 
-    plotSysVal['eod'] = True
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            pwrCall = pool.submit(call_inverter, SESSION, powerApiUrl)
+            stringCall = pool.submit(call_inverter, SESSION, stringApiUrl)
+        pwrData, ERRORSTATUS = pwrCall.result()
+        stringData, stringStatus = stringCall.result()
+        if ERRORSTATUS == "OK":
+            ERRORSTATUS = stringStatus
 
-    kWh, maxPwr = draw_graph(plotFnames, plotCfg, plotLabel, plotSysVal)
+        if ERRORSTATUS == "OK":
 
-    #   Write daily summary CSV
+            watts, timestampList, str1watts, str2watts =  calculate_power(pwrData, \
+                                                          stringData, today)
 
-    write_csv(SUMMARYCSV, timeIso, kWh, maxPwr)
+            #   Write out the aggregate and string CSVs
 
-    #   Write URL to history html at top of file
+            write_csv(dailyCsv, timeIso, watts)
+            update_daily_stats(dailyStats, watts, FIRSTRUN)
 
-    write_history_html(isHistoryHtml, HISTORYHTML, histHtmlStr)
+            #   Inverter returns the whole day of string data so this is an overwrite
 
-#   Log errors to stdout
+            with open(stringCsv, 'w', newline='') as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerows(zip(timestampList, str1watts, str2watts))
+
+            #   Only draw the graph if the CSV file exists and its not the first
+            #   iteration of the day
+
+            if isDailyCsv and not FIRSTRUN:
+
+                plotSysVal['watts'] = watts
+                draw_graph(plotFnames, plotCfg, plotLabel, plotSysVal)
+
+    #   At the end of the day save an archive image and CSV of timestamp,
+    #   kWh and peak output for the day. Overlay per string data.
+
+    if (timeNow > sunset and not isDailyPng and isDailyCsv and \
+        isStringCsv and not FORCEDAY) or FORCEEOD:
+
+        plotSysVal['eod'] = True
+
+        kWh, maxPwr = draw_graph(plotFnames, plotCfg, plotLabel, plotSysVal)
+
+        #   Write daily summary CSV
+
+        write_csv(SUMMARYCSV, timeIso, kWh, maxPwr)
+
+        #   Write URL to history html at top of file
+
+        write_history_html(isHistoryHtml, HISTORYHTML, histHtmlStr)
+
+    #   Log errors to stdout
+
+    log_errors(isDailyPng, isDailyCsv, isStringCsv, FIRSTRUN, ERRORSTATUS, timeIso)
+
+
+###############################################################################
 
-log_errors(isDailyPng, isDailyCsv, isStringCsv, FIRSTRUN, ERRORSTATUS, timeIso)
+#   Run once for cron, or stay resident and run at the top of every minute.
+#   A failed iteration is logged rather than stopping the daemon
+
+if DAEMONMODE:
+    while True:
+        try:
+            run_capture()
+        except Exception:
+            print("\n" + datetime.datetime.now().isoformat() + " " + \
+                  traceback.format_exc())
+        sys.stdout.flush()
+        time.sleep(60 - time.time() % 60)
+else:
+    run_capture()